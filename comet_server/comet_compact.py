@@ -0,0 +1,315 @@
+"""
+Comet Server: Server extension paired with nbextension to track notebook use
+"""
+
+import os
+import sys
+import zlib
+import sqlite3
+import argparse
+import datetime
+from hashlib import sha1
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+from comet_server.comet_dir import find_storage_dir, catalog_path, archive_path, get_dir_size
+from comet_server.comet_sqlite import backfill_catalog
+
+# only diffs larger than this are worth replacing with a reference
+MIN_DEDUPE_SIZE = 128
+
+# wait this long in seconds for the live server to release a database lock
+LOCK_TIMEOUT = 30
+
+# rough size of an archive holding nothing: a schema page plus a page each for
+# the two tables and their primary key indexes, and a little per version
+ARCHIVE_OVERHEAD = 5 * 4096
+ARCHIVE_VERSION_OVERHEAD = 64
+
+def find_notebook_dirs(storage_dir):
+    """
+    find the storage dir of every tracked notebook, laid out as
+    <storage_dir>/<hashed path>/<name>/<name>.db
+    storage_dir: (str) root dir where Comet stores its data
+    """
+    notebook_dirs = []
+    for hashed_path in sorted(os.listdir(storage_dir)):
+        hash_dir = os.path.join(storage_dir, hashed_path)
+        if len(hashed_path) != 8 or not os.path.isdir(hash_dir):
+            continue
+        for fname in sorted(os.listdir(hash_dir)):
+            data_dir = os.path.join(hash_dir, fname)
+            if os.path.isfile(os.path.join(data_dir, fname + ".db")):
+                notebook_dirs.append(data_dir)
+    return notebook_dirs
+
+def dedupe_diffs(db):
+    """
+    move diff payloads that appear more than once into the diff_payloads table,
+    leaving a reference to the payload's digest in the actions table
+    db: (str) path to the notebook's sqlite database
+    """
+    conn = sqlite3.connect(db, timeout=LOCK_TIMEOUT)
+    c = conn.cursor()
+
+    # payloads stored by an earlier run count as repeated already
+    stored = set()
+    c.execute('''SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name = 'diff_payloads' ''')
+    if c.fetchone():
+        stored.update(row[0] for row in
+            c.execute('SELECT digest FROM diff_payloads'))
+
+    # first pass: count how often each payload occurs, keeping only digests
+    query = '''SELECT rowid, diff FROM actions
+        WHERE typeof(diff) = 'blob' AND length(diff) >= ?'''
+    counts = {}
+    for rowid, diff in c.execute(query, (MIN_DEDUPE_SIZE,)):
+        digest = 'sha1:' + sha1(diff).hexdigest()
+        counts[digest] = counts.get(digest, 0) + 1
+
+    # second pass: store each repeated payload once and point actions at it
+    updates = []
+    payloads = []
+    for rowid, diff in conn.cursor().execute(query, (MIN_DEDUPE_SIZE,)):
+        digest = 'sha1:' + sha1(diff).hexdigest()
+        if digest in stored or counts.get(digest, 0) > 1:
+            if digest not in stored:
+                payloads.append((digest, diff))
+                stored.add(digest)
+            updates.append((digest, rowid))
+
+    # nothing repeats, so don't grow the db with an empty table and index
+    if not updates:
+        conn.close()
+        return 0
+
+    try:
+        c.execute('''CREATE TABLE IF NOT EXISTS diff_payloads (digest text
+        PRIMARY KEY, diff blob)''')
+        c.executemany('INSERT OR IGNORE INTO diff_payloads VALUES (?,?)',
+                    payloads)
+        c.executemany('UPDATE actions SET diff = ? WHERE rowid = ?', updates)
+        conn.commit()
+    except:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return len(updates)
+
+def archive_saves_space(version_dir, versions):
+    """
+    check if packing versions into a new archive would take less space than
+    leaving them on disk
+    version_dir: (str) dir holding the time-stamped versions
+    versions: (list of str) file names of the versions to archive
+    """
+    savings = -ARCHIVE_OVERHEAD
+    digests = set()
+    for v in versions:
+        with open(os.path.join(version_dir, v), 'rb') as nb_file:
+            content = nb_file.read()
+        savings += len(content) - ARCHIVE_VERSION_OVERHEAD
+        digest = sha1(content).hexdigest()
+        if digest not in digests:
+            savings -= len(zlib.compress(content, 9))
+            digests.add(digest)
+        if savings > 0:
+            return True
+    return False
+
+def archive_versions(version_dir, min_age):
+    """
+    pack old versions into a compressed archive the viewer can still read,
+    storing identical snapshots only once
+    version_dir: (str) dir holding the time-stamped versions
+    min_age: (int) only archive versions older than this many days
+    """
+    versions = sorted(f for f in os.listdir(version_dir)
+        if os.path.isfile(os.path.join(version_dir, f))
+        and f[-6:] == '.ipynb')
+
+    # always leave the newest version on disk, as the server checks its
+    # time stamp to decide when to save the next one
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=min_age)
+    to_archive = [v for v in versions[:-1]
+        if datetime.datetime.strptime(v[-32:-6], "%Y-%m-%d-%H-%M-%S-%f")
+        < cutoff]
+    if not to_archive:
+        return 0
+
+    # a new archive has a fixed cost, so only start one once it would be
+    # smaller than the loose versions it replaces
+    if not os.path.isfile(archive_path(version_dir)):
+        if not archive_saves_space(version_dir, to_archive):
+            return 0
+
+    conn = sqlite3.connect(archive_path(version_dir), timeout=LOCK_TIMEOUT)
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS snapshots (digest text
+    PRIMARY KEY, content blob)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS versions (name text PRIMARY KEY,
+    digest text)''')
+    conn.commit()
+
+    archived = {}
+    try:
+        for v in to_archive:
+            with open(os.path.join(version_dir, v), 'rb') as nb_file:
+                content = nb_file.read()
+            digest = sha1(content).hexdigest()
+            c.execute('SELECT 1 FROM snapshots WHERE digest = ?', (digest,))
+            if not c.fetchone():
+                c.execute('INSERT INTO snapshots VALUES (?,?)',
+                        (digest, zlib.compress(content, 9)))
+            c.execute('INSERT OR REPLACE INTO versions VALUES (?,?)',
+                    (v, digest))
+            archived[v] = digest
+        conn.commit()
+    except:
+        conn.rollback()
+        conn.close()
+        raise
+
+    # only remove a version from disk once it reads back intact from the
+    # archive, so the viewer can always find it in one place or the other
+    for v, digest in archived.items():
+        c.execute('''SELECT content FROM versions JOIN snapshots
+            ON versions.digest = snapshots.digest WHERE name = ?''', (v,))
+        row = c.fetchone()
+        if row and sha1(zlib.decompress(row[0])).hexdigest() == digest:
+            os.remove(os.path.join(version_dir, v))
+    conn.close()
+    return len(archived)
+
+def vacuum_db(db, analyze=True):
+    """
+    rebuild a database to reclaim free pages and refresh query statistics
+    db: (str) path to the sqlite database
+    analyze: (bool) also run ANALYZE, if the database has any indexes
+    """
+    conn = sqlite3.connect(db, timeout=LOCK_TIMEOUT)
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index'")
+    analyze = analyze and c.fetchone()[0] > 0
+
+    # statistics only help the planner choose between indexes, so otherwise
+    # ANALYZE's table would just take up space
+    if not analyze:
+        c.execute('''SELECT name FROM sqlite_master 
+            WHERE type = 'table' AND name = 'sqlite_stat1' ''')
+        if c.fetchone():
+            c.execute('DROP TABLE sqlite_stat1')
+            conn.commit()
+
+    c.execute('VACUUM')
+    if analyze:
+        c.execute('ANALYZE')
+        conn.commit()
+    conn.close()
+
+def check_integrity(db):
+    # returns 'ok' or sqlite's description of the problems found
+    conn = sqlite3.connect(db, timeout=LOCK_TIMEOUT)
+    rows = conn.execute('PRAGMA integrity_check').fetchall()
+    conn.close()
+    return '; '.join(row[0] for row in rows)
+
+def compact_notebook(data_dir, min_age=7):
+    """
+    compact the stored data of a single notebook
+    data_dir: (str) Comet storage dir for the notebook
+    min_age: (int) only archive versions older than this many days
+
+    returns (dict) a report of the space reclaimed and work done
+    """
+    fname = os.path.basename(os.path.normpath(data_dir))
+    db = os.path.join(data_dir, fname + ".db")
+    version_dir = os.path.join(data_dir, "versions")
+    report = {'data_dir': data_dir,
+            'bytes_before': get_dir_size(data_dir),
+            'bytes_after': None,
+            'diffs_deduplicated': 0,
+            'versions_archived': 0,
+            'integrity': None,
+            'error': None}
+
+    try:
+        report['diffs_deduplicated'] = dedupe_diffs(db)
+        if os.path.isdir(version_dir):
+            report['versions_archived'] = archive_versions(version_dir, min_age)
+
+        dbs = [db]
+        vacuum_db(db)
+        if os.path.isfile(archive_path(version_dir)):
+            # the archive is only read by primary key, so skip ANALYZE
+            dbs.append(archive_path(version_dir))
+            vacuum_db(archive_path(version_dir), analyze=False)
+
+        problems = [d + ': ' + result for d, result in
+            ((d, check_integrity(d)) for d in dbs) if result != 'ok']
+        report['integrity'] = '; '.join(problems) if problems else 'ok'
+    except (sqlite3.Error, OSError) as e:
+        # usually a lock held by the live server; the next run will catch up
+        report['error'] = str(e)
+
+    report['bytes_after'] = get_dir_size(data_dir)
+    return report
+
+def compact_storage(storage_dir, min_age=7, jobs=None):
+    """
+    compact every notebook under the storage dir in parallel
+    storage_dir: (str) root dir where Comet stores its data
+    min_age: (int) only archive versions older than this many days
+    jobs: (int) number of worker processes, defaults to the number of CPUs
+    """
+    notebook_dirs = find_notebook_dirs(storage_dir)
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        reports = list(executor.map(partial(compact_notebook, min_age=min_age),
+                                    notebook_dirs))
+
+    # keep the catalog's record of disk use in step with the compaction, and
+    # add any notebooks that have not had an action since it was created
+    backfill_catalog(catalog_path(storage_dir), notebook_dirs)
+    return reports
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Compact and verify Comet's stored notebook data")
+    parser.add_argument('storage_dir', nargs='?', default=None,
+                        help="root dir where Comet stores its data")
+    parser.add_argument('--min-age', type=int, default=7,
+                        help="only archive versions older than this many days")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="number of worker processes")
+    parser.add_argument('--catalog-only', action='store_true',
+                        help="only add untracked notebooks to the catalog")
+    args = parser.parse_args(argv)
+
+    storage_dir = args.storage_dir or find_storage_dir()
+    if args.catalog_only:
+        notebook_dirs = find_notebook_dirs(storage_dir)
+        backfill_catalog(catalog_path(storage_dir), notebook_dirs)
+        print("Cataloged %d notebooks" % len(notebook_dirs))
+        return 0
+
+    reports = compact_storage(storage_dir, args.min_age, args.jobs)
+
+    total_reclaimed = 0
+    for r in reports:
+        reclaimed = r['bytes_before'] - r['bytes_after']
+        total_reclaimed += reclaimed
+        if r['error']:
+            status = 'error: ' + r['error']
+        else:
+            status = 'integrity ' + r['integrity']
+        print("%s: %d bytes reclaimed, %d diffs deduplicated, "
+            "%d versions archived, %s" % (r['data_dir'], reclaimed,
+            r['diffs_deduplicated'], r['versions_archived'], status))
+    print("Reclaimed %d bytes across %d notebooks" % (total_reclaimed,
+                                                    len(reports)))
+    return 1 if any(r['error'] or r['integrity'] != 'ok' for r in reports) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
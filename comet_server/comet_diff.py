@@ -5,6 +5,9 @@ Comet Server: Server extension paired with nbextension to track notebook use
 import os
 import nbformat
 
+# long output payloads are compared at each end, this many characters, first
+SAMPLE_SIZE = 1024
+
 def get_diff_at_indices(indices, action_data, dest_fname,
                         compare_outputs = False):
     """
@@ -37,25 +40,78 @@ def get_diff_at_indices(indices, action_data, dest_fname,
             diff[i] = current_nb[i]
         # compare outputs
         elif compare_outputs and current_nb[i]["cell_type"] == "code":
-            prior_outs = prior_nb[i]['outputs']
-            current_outs = current_nb[i]['outputs']
-            if len(prior_outs) != len(current_outs):
+            if outputs_differ(prior_nb[i]['outputs'], current_nb[i]['outputs']):
                 diff[i] = current_nb[i]
-                break
-            for j in range(len(current_outs)):
-                # check that the output type matches
-                if prior_outs[j]['output_type'] != current_outs[j]['output_type']:
-                    diff[i] = current_nb[i]                    
-                # and that the relevant data matches
-                elif((prior_outs[j]['output_type'] in ["display_data","execute_result"]
-                    and prior_outs[j]['data'] != current_outs[j]['data'])
-                    or (prior_outs[j]['output_type'] == "stream"
-                    and prior_outs[j]['text'] != current_outs[j]['text'])
-                    or (prior_outs[j]['output_type'] == "error"
-                    and prior_outs[j]['evalue'] != current_outs[j]['evalue'])):
-                    diff[i] = current_nb[i]
     return diff
 
+def payload_length(payload):
+    """
+    Get the length of an output payload without joining or copying it
+    payload: (str, list of str, or dict) output text or mime bundle value
+    """
+    if isinstance(payload, str):
+        return len(payload)
+    elif isinstance(payload, list):
+        return sum(len(line) for line in payload)
+    return None # e.g. application/json data, compared directly
+
+def payloads_equal(prior, current):
+    """
+    Compare two output payloads, checking lengths and the ends of long
+    payloads before falling back to a full comparison
+    prior: (str, list of str, or dict) payload from the saved notebook
+    current: (str, list of str, or dict) payload from the new notebook
+    """
+    # multiline payloads may be stored as lists of lines
+    if isinstance(prior, list):
+        prior = ''.join(prior)
+    if isinstance(current, list):
+        current = ''.join(current)
+    if not (isinstance(prior, str) and isinstance(current, str)):
+        return prior == current
+
+    if len(prior) != len(current):
+        return False
+    # streams that have grown differ at the tail, so check it first
+    if len(current) > 2 * SAMPLE_SIZE:
+        if (prior[-SAMPLE_SIZE:] != current[-SAMPLE_SIZE:]
+            or prior[:SAMPLE_SIZE] != current[:SAMPLE_SIZE]):
+            return False
+    return prior == current
+
+def outputs_differ(prior_outs, current_outs):
+    """
+    Check if the outputs of a code cell have changed, comparing cheap signals
+    (output count, type, mime keys and payload lengths) for every output
+    before comparing any payload contents
+    prior_outs: (list) outputs of the cell in the saved notebook
+    current_outs: (list) outputs of the cell in the new notebook
+    """
+    if len(prior_outs) != len(current_outs):
+        return True
+
+    to_compare = []
+    for prior, current in zip(prior_outs, current_outs):
+        # check that the output type matches
+        output_type = current['output_type']
+        if prior['output_type'] != output_type:
+            return True
+
+        # and collect the relevant data
+        if output_type in ["display_data", "execute_result"]:
+            if set(prior['data']) != set(current['data']):
+                return True
+            for mime in current['data']:
+                to_compare.append((prior['data'][mime], current['data'][mime]))
+        elif output_type == "stream":
+            to_compare.append((prior['text'], current['text']))
+        elif output_type == "error":
+            to_compare.append((prior['evalue'], current['evalue']))
+
+    if any(payload_length(p) != payload_length(c) for p, c in to_compare):
+        return True
+    return not all(payloads_equal(p, c) for p, c in to_compare)
+
 def indices_to_check(action, selected_index, selected_indices, len_current, 
                     len_prior):
     """
@@ -4,6 +4,8 @@ Comet Server: Server extension paired with nbextension to track notebook use
 
 import os
 import json
+import zlib
+import sqlite3
 import datetime
 from hashlib import sha1
 
@@ -17,6 +19,9 @@ def find_storage_dir():
                 storage_dir = data["Comet"]["data_directory"]
     return storage_dir
     
+def catalog_path(storage_dir):
+    return os.path.join(storage_dir, 'comet_catalog.db')
+
 def default_storage_dir():
     return os.path.expanduser('~/.jupyter')
             
@@ -45,6 +50,74 @@ def was_saved_recently(version_dir, min_time=60):
     else:
         return False
         
+def archive_path(version_dir):
+    return os.path.join(version_dir, 'archive.db')
+
+def list_versions(version_dir):
+    """ list saved versions of the notebook, oldest first, including versions
+    packed into the archive by comet_compact
+
+    version_dir: (str) dir holding the time-stamped versions """
+
+    versions = set(f for f in os.listdir(version_dir)
+        if os.path.isfile(os.path.join(version_dir, f))
+        and f[-6:] == '.ipynb')
+    if os.path.isfile(archive_path(version_dir)):
+        conn = sqlite3.connect(archive_path(version_dir))
+        c = conn.cursor()
+        # an archive without tables holds no versions (e.g., one left empty
+        # by an interrupted compaction)
+        c.execute("""SELECT name FROM sqlite_master 
+            WHERE type = 'table' AND name = 'versions' """)
+        if c.fetchone():
+            c.execute("SELECT name FROM versions")
+            versions.update(row[0] for row in c.fetchall())
+        conn.close()
+    return sorted(versions)
+
+def read_version(version_dir, version):
+    """ read the JSON text of a saved version, from disk or the archive
+
+    version_dir: (str) dir holding the time-stamped versions
+    version: (str) file name of the version """
+
+    # check for a loose file first, as recent versions are never archived
+    nb_path = os.path.join(version_dir, version)
+    if os.path.isfile(nb_path):
+        try:
+            with open(nb_path, encoding='utf-8') as nb_file:
+                return nb_file.read()
+        except (IOError, OSError):
+            pass # file was archived since we checked for it
+
+    # never connect to a missing archive, as that would create an empty one
+    if not os.path.isfile(archive_path(version_dir)):
+        raise IOError("No saved version %s in %s" % (version, version_dir))
+
+    conn = sqlite3.connect(archive_path(version_dir))
+    c = conn.cursor()
+    c.execute('''SELECT content FROM versions JOIN snapshots 
+        ON versions.digest = snapshots.digest WHERE name = ?''', (version,))
+    row = c.fetchone()
+    conn.close()
+    if row is None:
+        raise IOError("No saved version %s in %s" % (version, version_dir))
+    return zlib.decompress(row[0]).decode('utf-8')
+
+def get_dir_size(directory):
+    """ total size in bytes of all files under a directory
+
+    directory: (str) dir to measure """
+
+    bytes_used = 0
+    for root, dirs, files in os.walk(directory):
+        for f in files:
+            try:
+                bytes_used += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass # file removed while walking, e.g. a sqlite journal
+    return bytes_used
+
 def hash_path(path):    
     h = sha1(path.encode())
     return h.hexdigest()[0:8] #only need first 8 chars to be uniquely identified
@@ -0,0 +1,218 @@
+"""
+Comet Server: Server extension paired with nbextension to track notebook use
+"""
+
+import os
+import sys
+import json
+import gzip
+import pickle
+import sqlite3
+import argparse
+
+from comet_server.comet_dir import list_versions
+from comet_server.comet_viewer import get_version_labels
+
+ACTION_COLUMNS = ['rowid', 'time', 'name', 'cell_index', 'selected_cells',
+                'diff']
+VERSION_COLUMNS = ['version', 'time', 'num_cells', 'cells']
+
+def decode_diff(raw_diff):
+    """
+    Turn a pickled diff from the actions table into a JSON-ready dict
+    raw_diff: (bytes) pickled dict of cell index to cell
+    """
+    if raw_diff is None:
+        return {}
+    diff = pickle.loads(raw_diff)
+    return {str(k): v for k, v in diff.items()}
+
+def iter_action_chunks(db, after=0, chunk_size=500):
+    """
+    Stream the actions table in fixed-size chunks, decoding diffs as we go
+    db: (str) path to the notebook's sqlite database
+    after: (int) only export actions with a rowid greater than this cursor
+    chunk_size: (int) number of actions to hold in memory at once
+    """
+    conn = sqlite3.connect(db)
+    try:
+        c = conn.cursor()
+
+        # comet_compact moves repeated diffs into diff_payloads, leaving the
+        # payload's digest in the actions table
+        c.execute('''SELECT name FROM sqlite_master 
+            WHERE type = 'table' AND name = 'diff_payloads' ''')
+        if c.fetchone():
+            c.execute('''SELECT a.rowid, a.time, a.name, a.cell_index, 
+                a.selected_cells, COALESCE(p.diff, a.diff) 
+                FROM actions a LEFT JOIN diff_payloads p ON a.diff = p.digest 
+                WHERE a.rowid > ? ORDER BY a.rowid''', (after,))
+        else:
+            c.execute('''SELECT rowid, time, name, cell_index, selected_cells, 
+                diff FROM actions WHERE rowid > ? ORDER BY rowid''', (after,))
+        while True:
+            rows = c.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield [{'rowid': r[0],
+                    'time': int(r[1]),
+                    'name': r[2],
+                    'cell_index': int(r[3]),
+                    'selected_cells': json.loads(r[4]),
+                    'diff': decode_diff(r[5])} for r in rows]
+    finally:
+        conn.close()
+
+def iter_version_chunks(version_dir, after='', chunk_size=50):
+    """
+    Stream summaries of the saved versions, reading one notebook at a time
+    version_dir: (str) dir holding the time-stamped versions
+    after: (str) only export versions whose filename sorts after this cursor
+    chunk_size: (int) number of summaries to hold in memory at once
+    """
+    if not os.path.isdir(version_dir):
+        return
+
+    chunk = []
+    for v in list_versions(version_dir):
+        if v <= after:
+            continue
+        labels = get_version_labels(version_dir, v)
+        chunk.append({'version': v,
+                    'time': v[-32:-6],
+                    'num_cells': len(labels),
+                    'cells': labels})
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def to_columns(chunk, columns):
+    """
+    Pivot a chunk of records into a dict of column name to values
+    chunk: (list of dicts) records to pivot
+    columns: (list of str) column names, in output order
+    """
+    return {col: [record[col] for record in chunk] for col in columns}
+
+def load_cursor(cursor_path):
+    cursor = {'actions': 0, 'versions': '', 'offsets': {}}
+    if os.path.isfile(cursor_path):
+        # cursors saved before offsets were tracked leave the files as they are
+        cursor['offsets'] = None
+        with open(cursor_path) as cursor_file:
+            cursor.update(json.load(cursor_file))
+    return cursor
+
+def save_cursor(cursor_path, cursor):
+    # write to a temp file first so an interrupted export leaves a valid cursor
+    tmp_path = cursor_path + '.tmp'
+    with open(tmp_path, 'w') as cursor_file:
+        json.dump(cursor, cursor_file)
+    os.replace(tmp_path, cursor_path)
+
+def open_at_cursor(path, cursor):
+    """
+    Open an output file for appending, first truncating anything written
+    after the cursor was last saved, e.g. by an export that was killed
+    path: (str) output file
+    cursor: (dict) export cursor holding the byte offset of each file
+    """
+    out_file = open(path, 'ab')
+    if cursor['offsets'] is not None:
+        out_file.truncate(cursor['offsets'].get(os.path.basename(path), 0))
+    out_file.seek(0, os.SEEK_END)
+    return out_file
+
+def export_stream(chunks, out_base, columns, cursor, cursor_key, cursor_field,
+                cursor_path):
+    """
+    Append chunks to a JSONL file and a gzipped columnar file, advancing the
+    cursor only after both files hold the whole chunk
+    chunks: (generator) yields lists of records
+    out_base: (str) output path without extension
+    columns: (list of str) column names for the columnar file
+    cursor: (dict) export cursor, updated in place
+    cursor_key: (str) entry of the cursor tracking this stream
+    cursor_field: (str) record field holding the cursor value
+    cursor_path: (str) where to persist the cursor
+    """
+    jsonl_path = out_base + '.jsonl'
+    col_path = out_base + '.columns.jsonl.gz'
+    num_exported = 0
+    with open_at_cursor(jsonl_path, cursor) as jsonl_file, \
+        open_at_cursor(col_path, cursor) as col_file:
+        if cursor['offsets'] is None:
+            cursor['offsets'] = {}
+        for chunk in chunks:
+            lines = ''.join(json.dumps(record) + '\n' for record in chunk)
+            jsonl_file.write(lines.encode('utf-8'))
+            # each chunk is a complete gzip member, so the file stays readable
+            # however many runs have appended to it
+            columns_line = json.dumps(to_columns(chunk, columns)) + '\n'
+            col_file.write(gzip.compress(columns_line.encode('utf-8')))
+            jsonl_file.flush()
+            col_file.flush()
+
+            cursor[cursor_key] = chunk[-1][cursor_field]
+            cursor['offsets'][os.path.basename(jsonl_path)] = jsonl_file.tell()
+            cursor['offsets'][os.path.basename(col_path)] = col_file.tell()
+            save_cursor(cursor_path, cursor)
+            num_exported += len(chunk)
+    return num_exported
+
+def export_history(data_dir, out_dir, chunk_size=500):
+    """
+    Export a notebook's actions and version summaries, resuming from the
+    cursor left by any previous export to the same directory
+    data_dir: (str) Comet storage dir for the notebook
+    out_dir: (str) dir to write the exported files to
+    chunk_size: (int) number of records to hold in memory at once
+
+    For each stream two files are appended to:
+        <hash>-<fname>-<stream>.jsonl: one JSON record per line
+        <hash>-<fname>-<stream>.columns.jsonl.gz: one JSON object of columns
+            per chunk
+    """
+    hash_dir, fname = os.path.split(os.path.normpath(data_dir))
+    db = os.path.join(data_dir, fname + ".db")
+    version_dir = os.path.join(data_dir, "versions")
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    # include the hashed path so notebooks with the same name (e.g., Untitled)
+    # exported to the same dir do not share files or cursors
+    out_name = os.path.basename(hash_dir) + "-" + fname
+    cursor_path = os.path.join(out_dir, out_name + ".cursor.json")
+    cursor = load_cursor(cursor_path)
+
+    num_actions = 0
+    if os.path.isfile(db):
+        num_actions = export_stream(
+            iter_action_chunks(db, cursor['actions'], chunk_size),
+            os.path.join(out_dir, out_name + "-actions"), ACTION_COLUMNS,
+            cursor, 'actions', 'rowid', cursor_path)
+
+    num_versions = export_stream(
+        iter_version_chunks(version_dir, cursor['versions'], chunk_size),
+        os.path.join(out_dir, out_name + "-versions"), VERSION_COLUMNS,
+        cursor, 'versions', 'version', cursor_path)
+
+    return (num_actions, num_versions)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export a notebook's Comet history to JSONL")
+    parser.add_argument('data_dir', help="Comet storage dir for the notebook")
+    parser.add_argument('out_dir', help="dir to write the exported files to")
+    parser.add_argument('--chunk-size', type=int, default=500,
+                        help="number of records to hold in memory at once")
+    args = parser.parse_args(argv)
+
+    num_actions, num_versions = export_history(args.data_dir, args.out_dir,
+                                                args.chunk_size)
+    print("Exported %d actions and %d versions" % (num_actions, num_versions))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -12,9 +12,9 @@ from notebook.base.handlers import IPythonHandler, path_regex
 
 from comet_server.comet_diff import get_diff_at_indices
 from comet_server.comet_git import verify_git_repository, git_commit
-from comet_server.comet_sqlite import DbManager
-from comet_server.comet_dir import find_storage_dir, create_dir, was_saved_recently, hash_path
-from comet_server.comet_viewer import get_viewer_html
+from comet_server.comet_sqlite import DbManager, update_catalog_size
+from comet_server.comet_dir import find_storage_dir, catalog_path, create_dir, was_saved_recently, hash_path
+from comet_server.comet_viewer import get_viewer_html, get_history_tile
 
 class CometHandler(IPythonHandler):
 
@@ -34,6 +34,23 @@ class CometHandler(IPythonHandler):
         hashed_path = hash_path(os_dir)
         data_dir = os.path.join(find_storage_dir(), hashed_path, fname)
         
+        # the visualization requests downsampled tiles of the version history
+        # as the user zooms, identified by the viewport width
+        width = self.get_argument('width', None)
+        if width is not None:
+            end = self.get_argument('end', None)
+            try:
+                width = int(width)
+                start = int(self.get_argument('start', 0))
+                end = int(end) if end is not None else None
+            except ValueError:
+                self.send_error(400)
+                return
+            tile = get_history_tile(data_dir, start, end, width)
+            self.set_header('Content-Type', 'application/json')
+            self.write(json.dumps(tile))
+            return
+
         # display visualization of comet data
         html = get_viewer_html(data_dir, fname)
         self.write(html)
@@ -60,7 +77,9 @@ class CometHandler(IPythonHandler):
 
         # set up connection with database
         if db_key not in self.db_manager_directory:
-            self.db_manager_directory[db_key] = DbManager(db_key, db_path)
+            catalog_db = catalog_path(find_storage_dir())
+            self.db_manager_directory[db_key] = DbManager(db_key, db_path,
+                                                        os_path, catalog_db)
             
         db_manager = self.db_manager_directory[db_key]
 
@@ -124,6 +143,13 @@ def save_changes(os_path, action_data, db_manager, track_git=True,
             if not was_saved_recently(version_dir):
                 nbformat.write(current_nb, ver_fname, nbformat.NO_CONVERT)
 
+                # measuring disk use means walking the notebook's storage dir,
+                # so only do it as often as versions are saved; like action
+                # counts, this is skipped if db_manager has no catalog
+                if db_manager.catalog_db:
+                    update_catalog_size(db_manager.catalog_db, dest_dir,
+                                        os_path)
+
         #TODO git takes a long time to finish, so consider throttling
         # track file changes with git
         # if track_git:
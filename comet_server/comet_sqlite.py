@@ -9,12 +9,18 @@ import nbformat
 from threading import Timer
 
 from comet_server.comet_diff import get_diff_at_indices, indices_to_check, get_action_diff
+from comet_server.comet_dir import get_dir_size
+
+# bump when the layout of a notebook's storage dir or actions table changes
+STORAGE_SCHEMA_VERSION = 1
 
 
 class DbManager(object):        
-    def __init__(self, db_key, db_path):
+    def __init__(self, db_key, db_path, os_path=None, catalog_db=None):
         self.db_key = db_key
         self.db_path = db_path
+        self.os_path = os_path
+        self.catalog_db = catalog_db
         self.commitTimer = None
         self.queue = []
         
@@ -57,11 +63,18 @@ class DbManager(object):
         try:
             self.c.executemany('INSERT INTO actions VALUES (?,?,?,?,?)', self.queue)        
             self.conn.commit()
+            batch = self.queue
             self.queue = []
         except:
             self.conn.rollback()
             raise
 
+        # count the batch in the catalog with a single write
+        if self.catalog_db and batch:
+            record_actions_to_catalog(self.catalog_db, self.os_path,
+                os.path.dirname(self.db_path), len(batch),
+                max(int(t[0]) for t in batch))
+
     def record_action_to_db(self, action_data, dest_fname):
         """
         save action to sqlite database
@@ -110,3 +123,179 @@ def get_viewer_data(db):
             last_time = rows[i][0]
             
     return (num_deletions, num_runs, total_time/1000)
+
+def connect_catalog(catalog_db):
+    """
+    connect to the catalog, creating its table if needed, since the storage
+    dir (and so the catalog) can change while the server is running
+    catalog_db: (str) path to the catalog database
+    """
+    # one row per tracked notebook, so admin tools need not walk the storage dir
+    conn = sqlite3.connect(catalog_db)
+    conn.execute('''CREATE TABLE IF NOT EXISTS notebooks (os_path text, 
+    storage_dir text, action_count integer, bytes_used integer, 
+    last_action_time integer, schema_version integer, 
+    PRIMARY KEY (storage_dir, os_path))''')
+    conn.commit()
+    return conn
+
+def claim_backfilled_row(c, os_path, storage_dir):
+    # rows added by backfill_catalog don't know the notebook's path, so the
+    # first notebook to record data in that storage dir takes them over
+    c.execute('''UPDATE OR IGNORE notebooks SET os_path = ? 
+        WHERE storage_dir = ? AND os_path IS NULL''', (os_path, storage_dir))
+
+def record_actions_to_catalog(catalog_db, os_path, storage_dir, num_actions,
+                            last_action_time):
+    """
+    count a batch of actions against a notebook in the catalog; failures are
+    logged rather than raised so they never interrupt action tracking
+    catalog_db: (str) path to the catalog database
+    os_path: (str) path to notebook as saved on the operating system
+    storage_dir: (str) dir where Comet stores the notebook's data
+    num_actions: (int) number of actions in the batch
+    last_action_time: (int) time the last action in the batch was performed
+    """
+    try:
+        conn = connect_catalog(catalog_db)
+    except sqlite3.Error as e:
+        print("Could not update Comet catalog: %s" % e)
+        return
+
+    c = conn.cursor()
+    try:
+        claim_backfilled_row(c, os_path, storage_dir)
+        c.execute('''INSERT OR IGNORE INTO notebooks VALUES (?,?,0,0,?,?)''',
+            (os_path, storage_dir, last_action_time, STORAGE_SCHEMA_VERSION))
+        c.execute('''UPDATE notebooks SET action_count = action_count + ?, 
+            last_action_time = MAX(COALESCE(last_action_time, 0), ?), 
+            schema_version = ? 
+            WHERE storage_dir = ? AND os_path = ?''',
+            (num_actions, last_action_time, STORAGE_SCHEMA_VERSION,
+            storage_dir, os_path))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print("Could not update Comet catalog: %s" % e)
+    finally:
+        conn.close()
+
+def update_catalog_size(catalog_db, storage_dir, os_path=None):
+    """
+    measure the disk space used by a notebook's data and save it to the
+    catalog; failures are logged rather than raised
+    catalog_db: (str) path to the catalog database
+    storage_dir: (str) dir where Comet stores the notebook's data
+    os_path: (str) path to notebook as saved on the operating system, or None
+        to update every notebook stored in storage_dir
+    """
+    bytes_used = get_dir_size(storage_dir)
+
+    try:
+        conn = connect_catalog(catalog_db)
+    except sqlite3.Error as e:
+        print("Could not update Comet catalog: %s" % e)
+        return
+
+    c = conn.cursor()
+    try:
+        if os_path is None:
+            c.execute('''UPDATE notebooks SET bytes_used = ? 
+                WHERE storage_dir = ?''', (bytes_used, storage_dir))
+        else:
+            # the first version is saved before the commit queue has added
+            # the notebook's row, so add it here if needed
+            claim_backfilled_row(c, os_path, storage_dir)
+            c.execute('''INSERT OR IGNORE INTO notebooks 
+                VALUES (?,?,0,0,NULL,?)''',
+                (os_path, storage_dir, STORAGE_SCHEMA_VERSION))
+            c.execute('''UPDATE notebooks SET bytes_used = ? 
+                WHERE storage_dir = ? AND os_path = ?''',
+                (bytes_used, storage_dir, os_path))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        print("Could not update Comet catalog: %s" % e)
+    finally:
+        conn.close()
+
+def backfill_catalog(catalog_db, notebook_dirs):
+    """
+    add notebooks tracked before the catalog existed, or that have not had an
+    action since, seeding counts from their actions tables; notebooks already
+    in the catalog have their counts raised to match and their size refreshed
+    catalog_db: (str) path to the catalog database
+    notebook_dirs: (list of str) storage dirs of the notebooks to add
+    """
+    conn = connect_catalog(catalog_db)
+    c = conn.cursor()
+    for storage_dir in notebook_dirs:
+        fname = os.path.basename(os.path.normpath(storage_dir))
+        try:
+            db_conn = sqlite3.connect(os.path.join(storage_dir, fname + ".db"))
+            num_actions, last_action_time = db_conn.execute(
+                "SELECT COUNT(*), MAX(time) FROM actions").fetchone()
+            db_conn.close()
+        except sqlite3.Error as e:
+            print("Could not read actions for %s: %s" % (storage_dir, e))
+            continue
+        bytes_used = get_dir_size(storage_dir)
+
+        # the original path can't be recovered from the hashed storage dir,
+        # so it is left empty until the notebook's next action
+        c.execute("SELECT COUNT(*) FROM notebooks WHERE storage_dir = ?",
+                (storage_dir,))
+        num_rows = c.fetchone()[0]
+        if num_rows == 0:
+            c.execute('''INSERT INTO notebooks VALUES (NULL,?,?,?,?,?)''',
+                (storage_dir, num_actions, bytes_used, last_action_time,
+                STORAGE_SCHEMA_VERSION))
+        elif num_rows == 1:
+            c.execute('''UPDATE notebooks SET 
+                action_count = MAX(action_count, ?), bytes_used = ?, 
+                last_action_time = MAX(COALESCE(last_action_time, 0), ?) 
+                WHERE storage_dir = ?''',
+                (num_actions, bytes_used, last_action_time or 0, storage_dir))
+        else:
+            # several notebooks share this dir, so the counts can't be split
+            c.execute('''UPDATE notebooks SET bytes_used = ? 
+                WHERE storage_dir = ?''', (bytes_used, storage_dir))
+        conn.commit()
+    conn.close()
+
+def get_catalog_notebooks(catalog_db, active_since=None):
+    """
+    list tracked notebooks, most recently active first
+    catalog_db: (str) path to the catalog database
+    active_since: (int) only list notebooks with an action after this time
+    """
+    conn = connect_catalog(catalog_db)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    if active_since is None:
+        c.execute('''SELECT * FROM notebooks 
+            ORDER BY last_action_time DESC''')
+    else:
+        c.execute('''SELECT * FROM notebooks WHERE last_action_time > ? 
+            ORDER BY last_action_time DESC''', (active_since,))
+    rows = [dict(r) for r in c.fetchall()]
+    conn.close()
+    return rows
+
+def get_catalog_collisions(catalog_db):
+    """
+    find storage dirs shared by more than one notebook, which happens when the
+    8 character hash of two notebooks' directories is the same
+    catalog_db: (str) path to the catalog database
+    """
+    conn = connect_catalog(catalog_db)
+    c = conn.cursor()
+    c.execute('''SELECT storage_dir, os_path FROM notebooks 
+        WHERE storage_dir IN (SELECT storage_dir FROM notebooks 
+        GROUP BY storage_dir HAVING COUNT(*) > 1) 
+        ORDER BY storage_dir''')
+    collisions = {}
+    for storage_dir, os_path in c.fetchall():
+        collisions.setdefault(storage_dir, []).append(os_path)
+    conn.close()
+    return collisions
@@ -5,8 +5,122 @@ Comet Server: Server extension paired with nbextension to track notebook use
 import os
 import datetime
 import nbformat
+from functools import lru_cache
 
 from comet_server.comet_sqlite import get_viewer_data
+from comet_server.comet_dir import list_versions, read_version
+
+# single character codes used to run-length encode cell labels for the viewer
+LABEL_CODES = {'markdown': 'm',
+                'code': 'c',
+                'raw': 'w',
+                'error': 'e',
+                'stream': 's',
+                'execute_result': 'r',
+                'display_data': 'd'}
+
+def get_cell_label(cell):
+    """
+    Label a cell by its type, or for code cells by its "highest" level output
+    cells can have multiple outputs, each with a different type, so here we
+    track error > display_data > execute result > stream
+    cell: (dict) notebook cell
+    """
+    cell_type = cell['cell_type']
+    if cell_type == "code":
+        output_types = [x['output_type'] for x in cell['outputs']]
+        if "error" in output_types:
+            cell_type = "error"
+        elif "display_data" in output_types:
+            cell_type = "display_data"
+        elif "execute_result" in output_types:
+            cell_type = "execute_result"
+        elif "stream" in output_types:
+            cell_type = "stream"
+    return cell_type
+
+def get_version_labels(version_dir, version):
+    """
+    Get the label of every cell in a saved version of the notebook
+    version_dir: (str) dir holding the time-stamped versions
+    version: (str) file name of the version
+    """
+    nb_text = read_version(version_dir, version)
+    nb_cells = nbformat.reads(nb_text, nbformat.NO_CONVERT)['cells']
+    return [get_cell_label(c) for c in nb_cells]
+
+def encode_labels(labels):
+    """
+    Run-length encode cell labels, e.g. ['code', 'code', 'markdown'] -> '2c1m'
+    labels: (list of str) cell labels as produced by get_cell_label
+    """
+    runs = []
+    for code in (LABEL_CODES.get(l, 'c') for l in labels):
+        if runs and runs[-1][1] == code:
+            runs[-1][0] += 1
+        else:
+            runs.append([1, code])
+    return ''.join('%d%s' % (n, code) for n, code in runs)
+
+# saved versions never change, so their encoded labels can be cached; keep
+# enough for a few full-width views of the history
+@lru_cache(maxsize=8192)
+def get_encoded_labels(version_dir, version):
+    """
+    Get the run-length encoded cell labels of a saved version, using the cache
+    version_dir: (str) dir holding the time-stamped versions
+    version: (str) file name of the version
+    """
+    return encode_labels(get_version_labels(version_dir, version))
+
+def get_version_time(version):
+    #TODO these datetime conversions seem hacky
+    return datetime.datetime.strptime(version[-32:-6], "%Y-%m-%d-%H-%M-%S-%f")
+
+def get_history_tile(data_dir, start=0, end=None, width=960):
+    """
+    Downsample a range of versions so that it fits in a viewport
+    data_dir: (str) Comet storage dir for the notebook
+    start: (int) index of the first version in the range
+    end: (int) index one past the last version in the range, None for all
+    width: (int) maximum number of columns to return
+
+    Consecutive versions are grouped into at most `width` buckets and each
+    bucket is drawn using the last version it contains, so only that many
+    notebooks are read no matter how long the history is.
+    """
+    version_dir = os.path.join(data_dir, 'versions')
+    versions = list_versions(version_dir) if os.path.isdir(version_dir) else []
+    total = len(versions)
+    end = total if end is None else min(end, total)
+    start = max(0, min(start, end))
+    num_versions = end - start
+    num_buckets = min(num_versions, max(1, width))
+
+    tile = {'start': start,
+            'end': end,
+            'total': total,
+            'gaps': [],
+            'versions': []}
+
+    for b in range(num_buckets):
+        first = start + b * num_versions // num_buckets
+        last = start + (b + 1) * num_versions // num_buckets - 1
+
+        # consider 15 minutes of inactivity as a gap in editing
+        for i in range(max(first, start + 1), last + 1):
+            time_diff = (get_version_time(versions[i])
+                        - get_version_time(versions[i-1]))
+            if time_diff.total_seconds() >= 15 * 60:
+                tile['gaps'].append(b)
+                break
+
+        tile['versions'].append({'first': first,
+                                'last': last,
+                                'time': versions[last][-32:-6],
+                                'cells': get_encoded_labels(version_dir,
+                                                            versions[last])})
+    return tile
 
 def get_viewer_html(data_dir, fname):
     version_dir = os.path.join(data_dir, 'versions')
@@ -18,51 +132,7 @@ def get_viewer_html(data_dir, fname):
                 'editTime': totalTime,
                 'numRuns': numRuns,
                 'numDeletions': numDeletions,
-                'gaps': [],
-                'versions':[]};
-        
-        versions = [f for f in os.listdir(version_dir)
-            if os.path.isfile(os.path.join(version_dir, f))
-            and f[-6:] == '.ipynb']
-
-        for i, v in enumerate(versions):            
-            if i > 0:
-                #TODO these datetime conversions seem hacky
-                current_nb_time = datetime.datetime.strptime(v[-32:-6], 
-                    "%Y-%m-%d-%H-%M-%S-%f")
-                past_nb_time = datetime.datetime.strptime(versions[i-1][-32:-6], 
-                    "%Y-%m-%d-%H-%M-%S-%f")
-                time_diff = current_nb_time - past_nb_time
-                # consider 15 minutes of inactivity as a gap in editing
-                if time_diff.total_seconds() >= 15 * 60:
-                    data['gaps'].append(i)
-            
-            version_data = {'num': i,
-                            'time': v[-26:],
-                            'cells':[]};
-                        
-            nb_path = os.path.join(version_dir, v)
-            nb_cells = nbformat.read(nb_path, nbformat.NO_CONVERT)['cells']
-            
-            # cells can have multiple outputs , each with a different type
-            # here we track the "highest" level output with 
-            # error > display_data > execute result > stream
-            for c in nb_cells:
-                cell_type = c.cell_type
-                if c.cell_type == "code":
-                    output_types = [x.output_type for x in c.outputs]
-                    if "error" in output_types:
-                        cell_type = "error"
-                    elif "display_data" in output_types:
-                        cell_type = "display_data"
-                    elif "execute_result" in output_types:
-                        cell_type = "execute_result"
-                    elif "stream" in output_types:
-                        cell_type = "stream"        
-                
-                version_data['cells'].append(cell_type)
-            
-            data['versions'].append(version_data)        
+                'numVersions': len(list_versions(version_dir))};
         
         #TODO find a way to use a template rather than dump all the HTML here
         html = """<!DOCTYPE html>\n
@@ -85,19 +155,20 @@ def get_viewer_html(data_dir, fname):
             <script>\n
             var width = 960;\n
             var height = 600;\n
-            var cellSize = 16;\n
+            var maxCellSize = 16;\n
             \n
             var data = """ + str(data) + """\n
             \n
-            var maxLength = 0\n
-            for (i = 0; i < data.versions.length; i++){\n
-                maxLength = Math.max(data.versions[i].cells.length, maxLength)\n
+            var type_colors = {\n
+                "m": "#7da7ca",\n
+                "c": "silver",\n
+                "w": "silver",\n
+                "e": "#ca7da7",\n
+                "s": "grey",\n
+                "r": "grey",\n
+                "d": "#a7ca7d"\n
             }\n
             \n
-            cellSize = Math.min(cellSize, width / (data.versions.length + data.gaps.length))\n
-            \n
-            cellSize = Math.min(cellSize, height / maxLength)\n
-            \n            
             var legend_colors = [\n
                 ["markdown", "#7da7ca"],\n
                 ["no output", "silver"],\n
@@ -147,43 +218,102 @@ def get_viewer_html(data_dir, fname):
                 .attr("class", "stat")\n
                     .append("h2")\n
                     .text(function(){\n
-                        text = data.versions.length.toString() + " versions";\n
+                        text = data.numVersions.toString() + " versions";\n
                         return text;\n
                 })\n
             \n
-            var svg = d3.select("body")\n
-                .append("svg")\n
+            // versions are drawn on a canvas, one rect per run of same-typed
+            // cells, so the page stays light however long the history is
+            var container = d3.select("body")\n
+                .append("div")\n
+                .style("position", "relative")\n
+                .style("clear", "both")\n
+            \n
+            var canvas = container.append("canvas")\n
+                .attr("width", width)\n
+                .attr("height", height)\n
+            var ctx = canvas.node().getContext("2d");\n
+            \n
+            // drag across the history to zoom in, double click to zoom out
+            var svg = container.append("svg")\n
                 .attr("width", width)\n
                 .attr("height", height)\n
+                .style("position", "absolute")\n
+                .style("left", 0)\n
+                .style("top", 0)\n
+            \n
+            var tile = null;\n
+            var columns = [];\n
+            \n
+            function decodeRuns(encoded){\n
+                var runs = [];\n
+                var re = /([0-9]+)([a-z])/g;\n
+                var m;\n
+                while ((m = re.exec(encoded)) !== null){\n
+                    runs.push([parseInt(m[1]), m[2]]);\n
+                }\n
+                return runs;\n
+            }\n
+            \n
+            function loadTile(start, end){\n
+                var url = window.location.pathname + "?width=" + width + "&start=" + start;\n
+                if (end !== null){ url = url + "&end=" + end; }\n
+                d3.json(url, function(error, t){\n
+                    if (error) throw error;\n
+                    tile = t;\n
+                    draw();\n
+                });\n
+            }\n
+            \n
+            function draw(){\n
+                var numCols = tile.versions.length + tile.gaps.length;\n
+                var runsByVersion = tile.versions.map(function(v){ return decodeRuns(v.cells); });\n
+                var maxLength = d3.max(runsByVersion, function(runs){\n
+                    return d3.sum(runs, function(r){ return r[0]; });\n
+                }) || 1;\n
+                var colWidth = Math.min(maxCellSize, width / Math.max(numCols, 1));\n
+                var rowHeight = Math.min(maxCellSize, colWidth, (height - 100) / maxLength);\n
+                var pad = colWidth > 3 ? 1 : 0;\n
+                \n
+                ctx.clearRect(0, 0, width, height);\n
+                columns = [];\n
+                var numGaps = 0;\n
+                runsByVersion.forEach(function(runs, j){\n
+                    if (tile.gaps.indexOf(j) >= 0){ numGaps++; }\n
+                    var x = (j + numGaps) * colWidth;\n
+                    columns.push([x, tile.versions[j]]);\n
+                    var y = 0;\n
+                    runs.forEach(function(r){\n
+                        ctx.fillStyle = type_colors[r[1]];\n
+                        ctx.fillRect(x, y * rowHeight, colWidth - pad, r[0] * rowHeight - pad);\n
+                        y += r[0];\n
+                    });\n
+                });\n
+            }\n
+            \n
+            // find the version index shown at a given x position
+            function versionAt(x){\n
+                var v = columns[0][1];\n
+                for (var i = 0; i < columns.length && columns[i][0] <= x; i++){\n
+                    v = columns[i][1];\n
+                }\n
+                return v;\n
+            }\n
+            \n
+            var brush = d3.brushX()\n
+                .extent([[0, 0], [width, height - 100]])\n
+                .on("end", function(){\n
+                    if (!d3.event.selection || !columns.length) return;\n
+                    var start = versionAt(d3.event.selection[0]).first;\n
+                    var end = versionAt(d3.event.selection[1]).last + 1;\n
+                    svg.select(".brush").call(brush.move, null);\n
+                    loadTile(start, end);\n
+                });\n
             \n
-            var nb = svg.selectAll("g")\n
-                .data(data.versions)\n
-                .enter().append("g")\n
-            \n
-            nb.each(function(p, j) {\n
-                d3.select(this)\n
-                .selectAll("rect")\n
-                    .data(function(d){return d.cells; })\n
-                    .enter().append("rect")\n
-                    .attr("width", cellSize)\n
-                    .attr("height", cellSize)\n
-                    .attr("x", function(d, i){\n
-                        var numGaps = data.gaps.filter(function(x){return x<=j}).length
-                        return (j-1+numGaps)*cellSize; })\n
-                    .attr("y", function(d, i) { return i * cellSize; })\n
-                    .attr("fill", function(d) { 
-                        type_colors = {
-                            "markdown": "#7da7ca",
-                            "code": "silver",
-                            "error": "#ca7da7",
-                            "stream": "grey",
-                            "execute_result": "grey",
-                            "display_data": "#a7ca7d"
-                        }
-                        return type_colors[d]
-                     })\n
-                    .attr("stroke", "white");\n
-            });\n
+            svg.append("g")\n
+                .attr("class", "brush")\n
+                .call(brush)\n
+                .on("dblclick", function(){ loadTile(0, null); });\n
             \n
             var legend = svg.append('g')\n
                 .attr('transform', function(){return "translate(0," + (height - 100).toString() + ")"});\n
@@ -208,6 +338,7 @@ def get_viewer_html(data_dir, fname):
                 .text(function(d){ return d[0]; })
                 .attr('fill', '#666');\n            
             \n
+            loadTile(0, null);\n
             </script>\n
             </body>\n
             </html>"""  